@@ -0,0 +1,53 @@
+import hashlib
+import sqlite3
+from collections import OrderedDict
+from pathlib import Path
+
+
+# (model, prompt) -> (translation, provider); in-memory LRU in front of SQLite so re-runs skip finished chunks
+class TranslationCache:
+    def __init__(self, path: Path, memory_size: int = 512):
+        self.memory_size = memory_size
+        self._memory = OrderedDict()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS translations "
+            "(key TEXT PRIMARY KEY, result TEXT NOT NULL, provider TEXT NOT NULL)"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def make_key(prompt: str, model: str = '') -> str:
+        # Whitespace-normalised so reflowed but otherwise identical prompts still hit
+        normalized = ' '.join(prompt.split())
+        return hashlib.blake2b(f"{model}\x00{normalized}".encode('utf-8'), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> tuple[str, str] | None:
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        row = self._db.execute(
+            "SELECT result, provider FROM translations WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        self._remember(key, (row[0], row[1]))
+        return row[0], row[1]
+
+    def set(self, key: str, result: str, provider: str):
+        self._remember(key, (result, provider))
+        self._db.execute(
+            "INSERT OR REPLACE INTO translations (key, result, provider) VALUES (?, ?, ?)",
+            (key, result, provider)
+        )
+        self._db.commit()
+
+    def _remember(self, key: str, value: tuple[str, str]):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def close(self):
+        self._db.close()
@@ -1,28 +1,59 @@
-from .base import BaseProvider
+import httpx
+
+from .base import BaseProvider, create_http_client, create_http_limits, proxy_settings
 from .siliconflow import SiliconFlowProvider
 from .alibaba import AlibabaProvider
 from .openrouter import OpenRouterProvider
 
-def create_provider(provider_config: dict, timeout: float = 60.0) -> BaseProvider:
+def create_provider(provider_config: dict, timeout: float = 60.0, limits: httpx.Limits | None = None,
+                    http_client: httpx.AsyncClient | None = None) -> BaseProvider:
     name = provider_config['name']
     
     if name == 'siliconflow':
-        return SiliconFlowProvider(provider_config, timeout)
+        return SiliconFlowProvider(provider_config, timeout, limits, http_client)
     elif name == 'alibaba':
-        return AlibabaProvider(provider_config, timeout)
+        return AlibabaProvider(provider_config, timeout, limits, http_client)
     elif name == 'openrouter':
-        return OpenRouterProvider(provider_config, timeout)
+        return OpenRouterProvider(provider_config, timeout, limits, http_client)
     else:
         raise ValueError(f"Unknown provider: {name}")
 
-def get_enabled_providers(config: dict) -> list:
+def get_enabled_providers(config: dict, only: str | None = None) -> list:
     providers = []
     rate_config = config.get('rate_limit', {})
     timeout = rate_config.get('timeout', 60.0)
+    max_output_tokens = rate_config.get('max_output_tokens')
+    http_config = config.get('http') or {}
+    limits = create_http_limits(http_config)
+    # One pooled client per proxy setting, shared by every provider that uses it
+    http_clients = {}
     for p in config['providers']:
-        if p.get('enabled', True):
+        # Filter before construction so skipped providers never build clients
+        if p.get('enabled', True) and (only is None or p['name'] == only):
+            if max_output_tokens:
+                # Global cap on output; also shrinks chunk size via the provider's max_tokens
+                p = {**p, 'max_tokens': min(p.get('max_tokens', max_output_tokens), max_output_tokens)}
+            key = proxy_settings(p)
+            new_client = key not in http_clients
+            if new_client:
+                http_clients[key] = create_http_client(p, timeout, limits, http_config.get('http2', False))
             try:
-                providers.append(create_provider(p, timeout))
+                providers.append(create_provider(p, timeout, limits, http_clients[key]))
             except ValueError as e:
                 print(f"Warning: {e}")
+                if new_client:
+                    # Never used, so it holds no connections and needs no aclose()
+                    del http_clients[key]
     return providers
+
+async def close_providers(providers: list):
+    shared_clients = {}
+    for provider in providers:
+        if provider.http_client is not None and not provider._owns_client:
+            shared_clients[id(provider.http_client)] = provider.http_client
+        try:
+            await provider.aclose()
+        except Exception:
+            pass
+    for client in shared_clients.values():
+        await client.aclose()
@@ -1,65 +1,294 @@
+import re
+import json
+import time
+import asyncio
 from abc import ABC, abstractmethod
 import httpx
-from openai import OpenAI
+from openai import NOT_GIVEN, AsyncOpenAI
+
+try:
+    import orjson  # Optional: faster JSON for prompts, batch files and the config sidecar
+except ImportError:
+    orjson = None
+
+def json_dumps(obj) -> str:
+    # Compact separators so prompts (and their cache keys) are identical with or without orjson
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+def json_loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def proxy_settings(config: dict) -> tuple[str | None, bool]:
+    # An explicit `proxy` key (even null) bypasses the system proxy
+    if 'proxy' in config:
+        return config.get('proxy'), False
+    return None, True
+
+def create_http_limits(http_config: dict | None = None) -> httpx.Limits:
+    # Keep idle connections longer than the gap between rate-limited requests to avoid new TLS handshakes
+    http_config = http_config or {}
+    return httpx.Limits(
+        max_connections=http_config.get('max_connections', 100),
+        max_keepalive_connections=http_config.get('max_keepalive_connections', 20),
+        keepalive_expiry=http_config.get('keepalive_expiry', 15.0)
+    )
+
+def create_http_client(config: dict, timeout: float | httpx.Timeout = 60.0, limits: httpx.Limits | None = None,
+                       http2: bool = False) -> httpx.AsyncClient:
+    proxy, trust_env = proxy_settings(config)
+    client_args = dict(
+        limits=limits or create_http_limits(),
+        timeout=timeout,
+        proxy=proxy,
+        trust_env=trust_env
+    )
+    if http2:
+        # HTTP/2 multiplexes concurrent chunk requests over one TLS connection
+        try:
+            return httpx.AsyncClient(http2=True, **client_args)
+        except ImportError:
+            print("Warning: http2 needs the h2 package (pip install 'httpx[http2]'), using HTTP/1.1")
+    return httpx.AsyncClient(**client_args)
+
+_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0}
+
+def _header_number(headers, name: str) -> float | None:
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def header_seconds(headers, name: str) -> float | None:
+    # Accepts plain seconds, epoch timestamps and OpenAI-style durations ("1s", "6m0s", "20ms")
+    value = headers.get(name)
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        parts = _DURATION_RE.findall(value)
+        if not parts:
+            return None
+        seconds = sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+    else:
+        if seconds > 1e9:
+            seconds -= time.time()
+    return max(0.0, seconds)
+
+class RateState:
+    # Last rate-limit headers seen from a provider, plus an AIMD window on chunk size:
+    # grow additively while requests succeed, halve on 429
+    def __init__(self, increase: int = 500, decrease: float = 0.5):
+        self.increase = increase
+        self.decrease = decrease
+        self.chunk_limit: int | None = None
+        self.remaining_tokens: float | None = None
+        self.remaining_requests: float | None = None
+        self.blocked_until = 0.0  # time.monotonic() when an exhausted quota resets
+    
+    def update(self, headers):
+        self.remaining_tokens = _header_number(headers, 'x-ratelimit-remaining-tokens')
+        self.remaining_requests = _header_number(headers, 'x-ratelimit-remaining-requests')
+        # Quota used up: hold further requests until the provider says it refills
+        resets = []
+        if self.remaining_requests == 0:
+            resets.append(header_seconds(headers, 'x-ratelimit-reset-requests'))
+        if self.remaining_tokens == 0:
+            resets.append(header_seconds(headers, 'x-ratelimit-reset-tokens'))
+        resets = [r for r in resets if r is not None]
+        if resets:
+            self.blocked_until = time.monotonic() + max(resets)
+    
+    def wait_time(self) -> float:
+        return max(0.0, self.blocked_until - time.monotonic())
+    
+    def on_success(self):
+        if self.chunk_limit is not None:
+            self.chunk_limit += self.increase
+    
+    def on_rate_limited(self):
+        if self.chunk_limit is not None:
+            self.chunk_limit = int(self.chunk_limit * self.decrease)
+
+class TruncatedResponseError(Exception):
+    # Output hit max_tokens (finish_reason == 'length'); `partial` is what arrived before the cut-off
+    def __init__(self, message: str, partial: str = '', provider: str | None = None):
+        super().__init__(message)
+        self.partial = partial
+        self.provider = provider
+
+class ProviderCircuit:
+    # Circuit breaker: opens after `threshold` consecutive outage-type failures, then after
+    # `cooldown` seconds lets a single probe through (half-open); a success closes it again
+    def __init__(self, threshold: int = 3, cooldown: float = 60.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.fail_count = 0
+        self.opened_at: float | None = None
+        self.probing = False
+    
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+    
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self.probing or time.monotonic() - self.opened_at < self.cooldown:
+            return False
+        self.probing = True
+        return True
+    
+    def record_success(self):
+        self.fail_count = 0
+        self.opened_at = None
+        self.probing = False
+    
+    def end_probe(self):
+        self.probing = False
+    
+    def record_failure(self):
+        self.fail_count += 1
+        if self.probing or self.fail_count >= self.threshold:
+            self.opened_at = time.monotonic()
+        self.probing = False
 
 class BaseProvider(ABC):
-    def __init__(self, config: dict, api_key: str, timeout: float = 60.0):
+    def __init__(self, config: dict, api_key: str, timeout: float = 60.0, limits: httpx.Limits | None = None,
+                 http_client: httpx.AsyncClient | None = None):
         self.config = config
         self._max_tokens = config.get('max_tokens', 8000)
         self._context_limit = config.get('context_limit', 32000)
         provider_timeout = config.get('timeout', timeout)
-        if 'proxy' in config:
-            trust_env = False
-            proxy = config.get('proxy')
-        else:
-            trust_env = True
-            proxy = None
-        self.http_client = httpx.Client(
-            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
-            timeout=httpx.Timeout(provider_timeout),
-            proxy=proxy,
-            trust_env=trust_env
-        )
-        self.client = OpenAI(
+        # Streaming: read timeout bounds the gap between tokens, not the whole response
+        idle_timeout = config.get('stream_idle_timeout', min(provider_timeout, 60.0))
+        request_timeout = httpx.Timeout(provider_timeout, read=idle_timeout,
+                                        connect=config.get('connect_timeout', 5.0))
+        self._owns_client = http_client is None
+        if http_client is None:
+            http_client = create_http_client(config, request_timeout, limits)
+        self.http_client = http_client
+        self.client = AsyncOpenAI(
             api_key=api_key,
             base_url=config['base_url'],
-            timeout=provider_timeout,
+            timeout=request_timeout,
+            max_retries=0,  # Retries and backoff are handled by process_with_fallback
             http_client=self.http_client
         )
         self.name = config['name']
         self.model = config['model']
+        self.rate_state = RateState()
+        self.circuit = ProviderCircuit(config.get('circuit_threshold', 3), config.get('circuit_cooldown', 60.0))
+        self.disabled_until = 0.0  # time.monotonic() deadline; inf once credentials are rejected
     
     @property
     def context_limit(self) -> int:
         return self._context_limit
     
-    def close(self):
-        if hasattr(self, 'http_client') and self.http_client:
-            self.http_client.close()
-            self.http_client = None
+    @property
+    def supports_batch(self) -> bool:
+        return False
+    
+    async def aclose(self):
+        # Shared clients are closed by close_providers(), not by each provider
+        if self.http_client and self._owns_client:
+            await self.http_client.aclose()
+        self.http_client = None
     
-    def __enter__(self):
+    async def __aenter__(self):
         return self
     
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.close()
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
         return False
     
-    def __del__(self):
-        self.close()
-    
     @abstractmethod
-    def process(self, prompt: str, temperature: float = 0.7) -> str:
+    async def process(self, prompt: str, temperature: float = 0.7, json_output: bool = False) -> str:
         pass
+    
+    async def process_batch(self, prompts: list[str], temperature: float = 0.7,
+                            json_output: bool = False) -> list[str | None]:
+        raise NotImplementedError(f"{self.name} does not support batch requests")
 
 class OpenAICompatibleProvider(BaseProvider):
-    def process(self, prompt: str, temperature: float = 0.7) -> str:
+    @property
+    def supports_batch(self) -> bool:
+        # Opt-in: only some OpenAI-compatible endpoints implement /v1/batches
+        return bool(self.config.get('batch'))
+    
+    async def process(self, prompt: str, temperature: float = 0.7, json_output: bool = False) -> str:
         extra_body = self.config.get('extra_params')
-        response = self.client.chat.completions.create(
+        # Only request JSON mode from providers configured as supporting it; the prompt asks for JSON either way
+        response_format = {"type": "json_object"} if json_output and self.config.get('json_mode') else NOT_GIVEN
+        raw_response = await self.client.chat.completions.with_raw_response.create(
             model=self.model,
             messages=[{"role": "user", "content": prompt}],
             temperature=temperature,
             max_tokens=self._max_tokens,
-            extra_body=extra_body
+            extra_body=extra_body,
+            response_format=response_format,
+            stream=True
+        )
+        self.rate_state.update(raw_response.headers)
+        response = raw_response.parse()
+        parts = []
+        finish_reason = None
+        async with response:
+            async for chunk in response:
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.delta.content:
+                    parts.append(choice.delta.content)
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+        if finish_reason == 'length':
+            raise TruncatedResponseError(f"{self.name} output truncated at max_tokens ({self._max_tokens})",
+                                         ''.join(parts), self.name)
+        return ''.join(parts)
+    
+    async def process_batch(self, prompts: list[str], temperature: float = 0.7,
+                            json_output: bool = False) -> list[str | None]:
+        body = {"model": self.model, "temperature": temperature, "max_tokens": self._max_tokens}
+        body.update(self.config.get('extra_params') or {})
+        if json_output and self.config.get('json_mode'):
+            body["response_format"] = {"type": "json_object"}
+        lines = [
+            json_dumps({"custom_id": str(i), "method": "POST", "url": "/v1/chat/completions",
+                        "body": {**body, "messages": [{"role": "user", "content": prompt}]}})
+            for i, prompt in enumerate(prompts)
+        ]
+        batch_file = await self.client.files.create(
+            file=("batch.jsonl", '\n'.join(lines).encode('utf-8')), purpose="batch"
+        )
+        batch = await self.client.batches.create(
+            input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h"
         )
-        return response.choices[0].message.content or ""
+        
+        # Poll with backoff; jobs usually finish in minutes but may take up to the completion window
+        poll_interval = self.config.get('batch_poll_interval', 5.0)
+        deadline = time.monotonic() + self.config.get('batch_timeout', 24 * 3600)
+        while batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+            if time.monotonic() > deadline:
+                await self.client.batches.cancel(batch.id)
+                raise TimeoutError(f"Batch {batch.id} still {batch.status} after batch_timeout")
+            await asyncio.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, 60.0)
+            batch = await self.client.batches.retrieve(batch.id)
+        if batch.status != 'completed' or not batch.output_file_id:
+            raise RuntimeError(f"Batch {batch.id} ended as {batch.status}")
+        
+        output = await self.client.files.content(batch.output_file_id)
+        results = [None] * len(prompts)
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            record = json_loads(line)
+            choices = ((record.get('response') or {}).get('body') or {}).get('choices')
+            # Truncated answers count as missing (None) so the caller resends just those
+            if choices and choices[0].get('finish_reason') != 'length':
+                results[int(record['custom_id'])] = choices[0]['message']['content'] or ''
+        return results
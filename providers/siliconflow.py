@@ -1,9 +1,11 @@
 import os
+import httpx
 from .base import OpenAICompatibleProvider
 
 class SiliconFlowProvider(OpenAICompatibleProvider):
-    def __init__(self, config: dict, timeout: float = 60.0):
+    def __init__(self, config: dict, timeout: float = 60.0, limits: httpx.Limits | None = None,
+                 http_client: httpx.AsyncClient | None = None):
         api_key = os.getenv('SILICONFLOW_API_KEY')
         if not api_key:
             raise ValueError("SILICONFLOW_API_KEY not found in environment")
-        super().__init__(config, api_key, timeout)
+        super().__init__(config, api_key, timeout, limits, http_client)
@@ -1,60 +1,179 @@
 #!/usr/bin/env python3
+import os
 import re
+import copy
+import math
+import mmap
+import json
+import hashlib
 import time
+import random
+import asyncio
 import argparse
+import traceback
 from pathlib import Path
 
+import httpx
+import openai
 import yaml
 from dotenv import load_dotenv
 
-from providers import get_enabled_providers
+from cache import TranslationCache
+from providers import close_providers, get_enabled_providers
+from providers.base import TruncatedResponseError, header_seconds, json_dumps, json_loads
 
 load_dotenv()
 
 INPUT_DIR = Path("input")
 OUTPUT_DIR = Path("output")
 CONFIG_FILE = Path("config.yaml")
+CONFIG_CACHE_FILE = CONFIG_FILE.with_name(f".{CONFIG_FILE.name}.json")
+TRANSLATION_CACHE_FILE = Path(".cache/translations.sqlite3")
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)  # libyaml bindings when available
 SAFETY_MARGIN = 0.8  # Use 80% of context limit to leave room for prompt/response
+CHARS_PER_TOKEN = 1.8  # Conservative for Chinese output
+MIN_CHUNK_SIZE = 2000
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_MAX_PARALLEL_FILES = 2
+BATCH_MIN_CHUNKS = 5  # Below this a batch job's queueing delay outweighs the saved round-trips
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+RETRY_AFTER_JITTER = 0.5  # Spread out waiters released by the same Retry-After
+MAX_SPLIT_DEPTH = 3  # Halve a chunk every provider truncates at most this many times
+
+_TS_RE = re.compile(r'\d{2}:\d{2}:\d{2}')
+_BLOCK_SEP_RE = re.compile(r'\n\s*\n')  # One or more blank/whitespace-only lines
+_BLOCK_RE = re.compile(r'\[(\d+)\]\s*(.*?)(?=\[\d+\]|$)', re.DOTALL)
+_MARKER_RE = re.compile(r'\[(\d+)\]')
+_SENTENCE_RE = re.compile(r'[^。.!?]*[。.!?]|[^。.!?]+')  # Each sentence up to and including its terminator
+_NON_CJK_RE = re.compile(r'[^\u4e00-\u9fff]+')
+CHINESE_TARGETS = frozenset({'chinese', 'zh', '中文'})
+CJK_SCAN_WINDOW = 512
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+
+    async def acquire(self):
+        # Reserve a token before sleeping so concurrent waiters queue up in order
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+_config_cache: dict = {}
+
+
+def _read_config_sidecar(digest: str) -> dict | None:
+    try:
+        with open(CONFIG_CACHE_FILE, 'rb') as f:
+            cached = json_loads(f.read())
+    except (OSError, ValueError):
+        return None
+    if cached.get('digest') != digest:
+        return None
+    return cached.get('config')
+
+
+def _write_config_sidecar(digest: str, config: dict):
+    try:
+        # Only cache configs that survive a JSON round trip unchanged
+        if json.loads(json.dumps(config)) != config:
+            return
+        with open(CONFIG_CACHE_FILE, 'w', encoding='utf-8') as f:
+            json.dump({'digest': digest, 'config': config}, f, ensure_ascii=False)
+    except (OSError, TypeError, ValueError):
+        pass
 
 
 def load_config():
-    with open(CONFIG_FILE, encoding='utf-8') as f:
-        return yaml.safe_load(f)
+    # Key on the file's content, not its mtime: copies, checkouts and `touch -r` can keep a stale mtime
+    raw = CONFIG_FILE.read_bytes()
+    digest = hashlib.blake2b(raw, digest_size=16).hexdigest()
+    config = _config_cache.get(digest)
+    if config is None:
+        config = _read_config_sidecar(digest)
+        if config is None:
+            config = yaml.load(raw.decode('utf-8'), Loader=YAML_LOADER)
+            _write_config_sidecar(digest, config)
+        _config_cache.clear()
+        _config_cache[digest] = config
+    # Callers apply CLI overrides in place, so never hand out the cached dict
+    return copy.deepcopy(config)
+
+
+def find_srt_files(input_dir: Path) -> list[Path]:
+    # Single directory pass; also matches .SRT, which a case-sensitive glob misses
+    if not input_dir.is_dir():
+        return []
+    with os.scandir(input_dir) as entries:
+        return sorted(Path(entry.path) for entry in entries
+                      if entry.name.lower().endswith('.srt') and entry.is_file())
 
 
 def read_srt(file_path: Path) -> str:
-    with open(file_path, 'r', encoding='utf-8') as f:
-        return f.read()
+    # Decode straight from the page cache; mmap can't map an empty file
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            content = str(mm, 'utf-8')
+    # Same newline translation text-mode open() did
+    if '\r' in content:
+        content = content.replace('\r\n', '\n').replace('\r', '\n')
+    return content
+
+
+def _parse_srt_lines(lines: list[str]) -> dict:
+    # Slow path for malformed blocks: classify each line individually
+    block = {}
+    for line in lines:
+        line = line.rstrip()
+        if 'index' not in block and line.isdigit():
+            block['index'] = int(line)
+        elif 'timestamp' not in block and _TS_RE.match(line):
+            block['timestamp'] = line
+        else:
+            block.setdefault('text', []).append(line)
+    return block
 
 
 def parse_srt(srt_content: str) -> list[dict]:
     blocks = []
-    current_block = {}
-    lines = srt_content.strip().split('\n')
-    
-    for line in lines:
-        line = line.rstrip()
-        if not line:
-            if current_block:
-                blocks.append(current_block)
-                current_block = {}
-            continue
-        
-        if 'index' not in current_block and line.isdigit():
-            current_block['index'] = int(line)
-        elif 'timestamp' not in current_block and re.match(r'\d{2}:\d{2}:\d{2}', line):
-            current_block['timestamp'] = line
-        else:
-            if 'text' not in current_block:
-                current_block['text'] = []
-            current_block['text'].append(line)
-    
-    if current_block:
-        blocks.append(current_block)
-    
+    for raw_block in _BLOCK_SEP_RE.split(srt_content.strip()):
+        lines = raw_block.split('\n')
+        if len(lines) >= 2 and lines[0].isdigit() and _TS_RE.match(lines[1]):
+            block = {'index': int(lines[0]), 'timestamp': lines[1].rstrip()}
+            if len(lines) > 2:
+                block['text'] = [line.rstrip() for line in lines[2:]]
+            blocks.append(block)
+        elif raw_block:
+            blocks.append(_parse_srt_lines(lines))
     return blocks
 
 
+def load_srt_blocks(file_path: Path) -> list[dict]:
+    return parse_srt(read_srt(file_path))
+
+
+def dedupe_blocks(blocks: list[dict]) -> tuple[list[dict], list[int]]:
+    # Repeated lines (choruses, [MUSIC] tags) get one pseudo-index so each is translated once
+    unique = {}
+    id_map = []
+    for block in blocks:
+        text = ' '.join(block.get('text', ()))
+        # Blank blocks have nothing to translate (and no answer to check), so they get id 0
+        id_map.append(unique.setdefault(text, len(unique) + 1) if text.strip() else 0)
+    unique_blocks = [{'index': index, 'text': [text]} for text, index in unique.items()]
+    return unique_blocks, id_map
+
+
 def blocks_to_translatable_text(blocks: list[dict]) -> str:
     lines = []
     for block in blocks:
@@ -63,51 +182,93 @@ def blocks_to_translatable_text(blocks: list[dict]) -> str:
     return '\n'.join(lines)
 
 
-def parse_translated_text(text: str, expected_count: int) -> list[str]:
-    pattern = r'\[(\d+)\]\s*(.*?)(?=\[\d+\]|$)'
-    matches = re.findall(pattern, text, re.DOTALL)
-    
+def blocks_to_json_text(blocks: list[dict]) -> str:
+    return json_dumps([' '.join(block['text']) for block in blocks])
+
+
+def split_blocks_into_chunks(blocks: list[dict], max_size: int) -> list[list[dict]]:
+    # Structured output needs whole blocks per chunk so every chunk is a valid JSON array
+    chunks = []
+    current_chunk = []
+    current_size = 0
+    for block in blocks:
+        block_size = sum(len(line) + 1 for line in block['text']) + 3  # Quotes and separator
+        if current_size + block_size > max_size and current_chunk:
+            chunks.append(current_chunk)
+            current_chunk = []
+            current_size = 0
+        current_chunk.append(block)
+        current_size += block_size
+    if current_chunk:
+        chunks.append(current_chunk)
+    return chunks
+
+
+def parse_json_translations(text: str, blocks: list[dict]) -> dict[int, str]:
+    # Tolerate code fences or chatter around the JSON object
+    start, end = text.find('{'), text.rfind('}')
+    try:
+        translations = json_loads(text[start:end + 1])['translations']
+    except (ValueError, KeyError, TypeError):
+        # Model ignored the JSON instructions; try the [N] format, numbered by position in the chunk
+        by_position = parse_translated_map(text)
+        return {block['index']: by_position[i] for i, block in enumerate(blocks, 1) if i in by_position}
+    if not isinstance(translations, list) or len(translations) != len(blocks):
+        # Positions can't be trusted once the array length is off
+        return {}
+    return {block['index']: t.strip() for block, t in zip(blocks, translations) if isinstance(t, str) and t.strip()}
+
+
+def parse_translated_map(text: str) -> dict[int, str]:
+    # Keyed by the [N] the model echoed back, i.e. the original SRT index
     results = {}
-    for idx_str, content in matches:
-        idx = int(idx_str)
+    for idx_str, content in _BLOCK_RE.findall(text):
         content = content.strip()
         if content:
-            results[idx] = content
-    
-    output = []
-    for i in range(1, expected_count + 1):
-        output.append(results.get(i, ''))
-    return output
+            results[int(idx_str)] = content
+    return results
 
 
 def is_translated(text: str, target_lang: str) -> bool:
-    if target_lang.lower() in ('chinese', 'zh', '中文'):
-        chinese_chars = len(re.findall(r'[\u4e00-\u9fff]', text))
-        return chinese_chars > len(text) * 0.15
+    if target_lang.lower() in CHINESE_TARGETS:
+        threshold = len(text) * 0.15
+        if len(text) <= CJK_SCAN_WINDOW:
+            # Drop non-CJK runs in C and measure what is left; no per-match objects
+            return len(_NON_CJK_RE.sub('', text)) > threshold
+        # Long chunks: count a window at a time and stop as soon as the threshold is crossed
+        chinese_chars = 0
+        for start in range(0, len(text), CJK_SCAN_WINDOW):
+            chinese_chars += len(_NON_CJK_RE.sub('', text[start:start + CJK_SCAN_WINDOW]))
+            if chinese_chars > threshold:
+                return True
+        return False
     return bool(text.strip())
 
 
-def check_translation_completeness(translated_texts: list[str], config: dict, threshold: float = 0.9) -> tuple[bool, float]:
+def check_translation_completeness(blocks: list[dict], translations: list[str | None], config: dict,
+                                   threshold: float = 0.9) -> tuple[bool, float]:
+    # translations[i] belongs to blocks[i]; SRT numbering can repeat, so it is never used as a key
     target_lang = config.get('processing', {}).get('target_language', 'Chinese')
-    translated_count = sum(1 for t in translated_texts if t and is_translated(t, target_lang))
-    total = len(translated_texts)
+    text_pairs = [(block, translated) for block, translated in zip(blocks, translations)
+                  if ''.join(block.get('text', ())).strip()]
+    translated_count = sum(1 for _, translated in text_pairs if is_translated(translated or '', target_lang))
+    total = len(text_pairs)
     if total == 0:
         return False, 0.0
     rate = translated_count / total
     return rate >= threshold, rate
 
 
-def build_srt(blocks: list[dict], translated_texts: list[str]) -> str:
-    output = []
-    for i, block in enumerate(blocks):
-        output.append(str(i + 1))
-        output.append(block['timestamp'])
-        if i < len(translated_texts) and translated_texts[i]:
-            output.append(translated_texts[i])
+def iter_srt_lines(blocks: list[dict], translations: list[str | None]):
+    for i, (block, translated) in enumerate(zip(blocks, translations)):
+        if i:
+            yield '\n'
+        yield f"{i + 1}\n{block['timestamp']}\n"
+        if translated:
+            yield translated + '\n'
         else:
-            output.extend(block['text'])
-        output.append('')
-    return '\n'.join(output)
+            for line in block.get('text', ()):
+                yield line + '\n'
 
 
 def get_effective_chunk_size(providers) -> int:
@@ -115,18 +276,29 @@ def get_effective_chunk_size(providers) -> int:
     min_output = min(p._max_tokens for p in providers)
     # max_tokens limits OUTPUT: 1 token ≈ 2 Chinese chars
     # Translation typically 1:1 char ratio, so OUTPUT size ≈ INPUT size
-    output_limit_chars = int(min_output * 1.8)  # Conservative: 1.8 chars/token
-    return min(int(min_context * SAFETY_MARGIN), output_limit_chars)
+    output_limit_chars = int(min_output * CHARS_PER_TOKEN)
+    ceiling = min(int(min_context * SAFETY_MARGIN), output_limit_chars)
+    
+    # The primary provider's AIMD window shrinks chunks after 429s and grows back on success
+    floor = min(MIN_CHUNK_SIZE, ceiling)
+    state = providers[0].rate_state
+    if state.chunk_limit is None:
+        state.chunk_limit = ceiling
+    state.chunk_limit = max(floor, min(state.chunk_limit, ceiling))
+    chunk_size = state.chunk_limit
+    if state.remaining_tokens is not None:
+        chunk_size = max(floor, min(chunk_size, int(state.remaining_tokens * CHARS_PER_TOKEN * 0.8)))
+    return chunk_size
 
 
 def split_text_into_chunks(text: str, max_size: int) -> list[str]:
-    sentences = re.split(r'(?<=[。.!?])\s*', text)
     chunks = []
     current_chunk = []
     current_size = 0
     
-    for sentence in sentences:
-        sentence = sentence.strip()
+    # finditer walks the text lazily instead of materialising every sentence up front
+    for match in _SENTENCE_RE.finditer(text):
+        sentence = match.group().strip()
         if not sentence:
             continue
         sent_size = len(sentence)
@@ -143,28 +315,161 @@ def split_text_into_chunks(text: str, max_size: int) -> list[str]:
     return chunks
 
 
-def process_with_fallback(providers, prompt: str, config: dict) -> tuple[str, str]:
+def is_retryable_error(e: Exception) -> bool:
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code in RETRYABLE_STATUS_CODES
+    # Covers openai.APITimeoutError and raw httpx errors raised mid-stream
+    return isinstance(e, (openai.APIConnectionError, httpx.TransportError))
+
+
+def get_retry_after(e: Exception) -> float | None:
+    if not isinstance(e, openai.APIStatusError):
+        return None
+    headers = e.response.headers
+    retry_after = header_seconds(headers, 'retry-after')
+    if retry_after is None and e.status_code == 429:
+        # No Retry-After: wait for whichever quota window resets last
+        resets = [header_seconds(headers, name) for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens')]
+        resets = [r for r in resets if r is not None]
+        if resets:
+            retry_after = max(resets)
+    return retry_after
+
+
+def get_retry_delay(e: Exception, attempt: int, rate_config: dict) -> float:
+    retry_after = get_retry_after(e)
+    if retry_after is not None:
+        return retry_after + random.uniform(0, RETRY_AFTER_JITTER)
+    base = rate_config.get('retry_delay', 5)
+    cap = rate_config.get('retry_max_delay', 60)
+    jitter = rate_config.get('retry_jitter', 1.0)
+    return min(cap, base * 2 ** attempt) + random.uniform(0, jitter)
+
+
+async def process_with_fallback(providers, prompt: str, config: dict, bucket: TokenBucket,
+                                json_output: bool = False) -> tuple[str, str]:
     rate_config = config['rate_limit']
     max_retries = rate_config.get('max_retries', 3)
-    retry_delay = rate_config.get('retry_delay', 5)
+    truncated = None
     
     for provider in providers:
+        if provider.disabled_until > time.monotonic():
+            continue
+        # Hard deadline for the whole streamed call; the httpx read timeout only bounds gaps between tokens
+        deadline = provider.config.get('request_timeout', rate_config.get('request_timeout'))
         for attempt in range(max_retries):
+            wait = provider.rate_state.wait_time()
+            if wait > rate_config.get('retry_max_delay', 60):
+                print(f"    {provider.name} rate limited for {wait:.0f}s, trying next provider")
+                break
+            if wait:
+                print(f"    {provider.name} rate limited, waiting {wait:.1f}s")
+                await asyncio.sleep(wait)
+            if not provider.circuit.allow():
+                print(f"    Skipping {provider.name}: circuit open after repeated failures")
+                break
+            # allow() on an open circuit hands this call the single half-open probe
+            probing = provider.circuit.is_open
             try:
+                # Every attempt is a real request, so retries and fallbacks draw from the bucket too
+                await bucket.acquire()
                 print(f"    Trying {provider.name} ({provider.model}) attempt {attempt + 1}/{max_retries}")
-                result = provider.process(prompt)
+                result = await asyncio.wait_for(provider.process(prompt, json_output=json_output), deadline)
+                provider.rate_state.on_success()
+                provider.circuit.record_success()
                 return result, provider.name
+            except asyncio.TimeoutError:
+                provider.circuit.record_failure()
+                # A provider this slow will likely stall again; fail over without waiting retry_delay
+                print(f"    {provider.name} exceeded request_timeout ({deadline}s), trying next provider")
+                break
             except Exception as e:
-                import traceback
                 print(f"    Error with {provider.name}: {e}")
+                # Only outages count towards the breaker; a 4xx or 429 means the backend is up
+                if is_retryable_error(e) and getattr(e, 'status_code', None) != 429:
+                    provider.circuit.record_failure()
+                else:
+                    provider.circuit.record_success()
+                probing = False
+                if isinstance(e, TruncatedResponseError):
+                    # Retrying gets the same cut-off; shrink later chunks and let the next provider try this one
+                    provider.rate_state.on_rate_limited()
+                    if truncated is None or len(e.partial) > len(truncated.partial):
+                        truncated = e
+                    break
+                if isinstance(e, (openai.AuthenticationError, openai.PermissionDeniedError)):
+                    # A rejected key won't start working mid-run; skip this provider for later chunks too
+                    print(f"    Disabling {provider.name}: credentials rejected")
+                    provider.disabled_until = math.inf
+                    break
+                if isinstance(e, openai.APIStatusError):
+                    provider.rate_state.update(e.response.headers)
+                    if e.status_code == 429:
+                        provider.rate_state.on_rate_limited()
+                        retry_after = get_retry_after(e)
+                        if retry_after:
+                            # Make concurrent chunks on this provider wait out the same window
+                            provider.rate_state.blocked_until = max(provider.rate_state.blocked_until,
+                                                                    time.monotonic() + retry_after)
                 if attempt == 0:
                     print(f"    Debug traceback: {traceback.format_exc().splitlines()[-3:]}")
+                if not is_retryable_error(e):
+                    break
                 if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
+                    # Only a server-set wait can run long; our own backoff is already capped at retry_max_delay
+                    server_wait = get_retry_after(e)
+                    if server_wait is not None and server_wait > rate_config.get('retry_max_delay', 60):
+                        print(f"    {provider.name} asks to wait {server_wait:.0f}s, trying next provider")
+                        break
+                    await asyncio.sleep(get_retry_delay(e, attempt, rate_config))
+            finally:
+                if probing:
+                    # Cancelled (e.g. a lost hedge race) before a verdict; let the next call probe instead
+                    provider.circuit.end_probe()
     
+    # Truncation wins over other failures: the caller can split the chunk and try again
+    if truncated is not None:
+        raise truncated
     raise RuntimeError("All providers failed")
 
 
+async def process_hedged(providers, prompt: str, config: dict, bucket: TokenBucket,
+                         json_output: bool = False) -> tuple[str, str]:
+    rate_config = config['rate_limit']
+    hedge_after_ms = rate_config.get('hedge_after_ms')
+    if not hedge_after_ms or len(providers) < 2 or len(prompt) < rate_config.get('hedge_min_chars', 0):
+        return await process_with_fallback(providers, prompt, config, bucket, json_output)
+    
+    # The primary sticks to the first provider, so it never falls through onto the hedge's provider
+    primary = asyncio.create_task(process_with_fallback(providers[:1], prompt, config, bucket, json_output))
+    done, _ = await asyncio.wait({primary}, timeout=hedge_after_ms / 1000)
+    if done:
+        if primary.exception() is None:
+            return primary.result()
+        try:
+            return await process_with_fallback(providers[1:], prompt, config, bucket, json_output)
+        except RuntimeError:
+            if isinstance(primary.exception(), TruncatedResponseError):
+                raise primary.exception()
+            raise
+    
+    # Primary is slow: race the rest of the chain against it and keep whichever answers first
+    print(f"    {providers[0].name} still running after {hedge_after_ms}ms, hedging with {providers[1].name}")
+    pending = {primary, asyncio.create_task(process_with_fallback(providers[1:], prompt, config, bucket, json_output))}
+    errors = []
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                errors.append(task.exception())
+    finally:
+        for task in pending:
+            task.cancel()
+    raise next((e for e in errors if isinstance(e, TruncatedResponseError)), RuntimeError("All providers failed"))
+
+
 def build_prompt(prompt_template: str, raw_text: str, config: dict) -> str:
     source_lang = config['processing'].get('source_language', 'auto')
     target_lang = config['processing'].get('target_language', 'Chinese')
@@ -179,35 +484,259 @@ def build_prompt(prompt_template: str, raw_text: str, config: dict) -> str:
     )
 
 
-def process_large_text(providers, raw_text: str, config: dict) -> tuple[str, str | None]:
+def compile_prompt(prompt_template: str, config: dict):
+    # Render the template once around a placeholder, then splice content in with str.join
+    prompt_parts = build_prompt(prompt_template, '\x00', config).split('\x00')
+    return lambda content: content.join(prompt_parts)
+
+
+def expects_blocks(text: str):
+    # Completeness check for the [N] format: every index sent must come back with text
+    expected = {int(n) for n in _MARKER_RE.findall(text)}
+    return lambda result: expected <= parse_translated_map(result).keys()
+
+
+def expects_json_blocks(blocks: list[dict]):
+    return lambda result: len(parse_json_translations(result, blocks)) == len(blocks)
+
+
+def is_cacheable(result: str, config: dict, is_complete) -> bool:
+    # Partial answers are kept out of the cache so the next run asks again
+    target_lang = config['processing'].get('target_language', 'Chinese')
+    return is_translated(result, target_lang) and (is_complete is None or is_complete(result))
+
+
+async def process_cached(providers, prompt: str, config: dict, bucket: TokenBucket,
+                         cache: TranslationCache | None, json_output: bool = False,
+                         is_complete=None) -> tuple[str, str]:
+    # Keyed on the preferred model, so switching models re-translates instead of reusing old output
+    key = TranslationCache.make_key(prompt, providers[0].model)
+    cached = cache.get(key) if cache else None
+    if cached:
+        print(f"    Using cached translation ({cached[1]})")
+        return cached
+    result, provider = await process_hedged(providers, prompt, config, bucket, json_output)
+    if cache and is_cacheable(result, config, is_complete):
+        cache.set(key, result, provider)
+    return result, provider
+
+
+async def translate_prompts_batch(provider, prompts: list[str], config: dict, bucket: TokenBucket,
+                                  cache: TranslationCache | None, json_output: bool = False,
+                                  checks: list | None = None) -> list[tuple[str, str] | None]:
+    # None marks a chunk the batch did not answer; the caller sends those one by one
+    outcomes = [None] * len(prompts)
+    keys = [TranslationCache.make_key(prompt, provider.model) for prompt in prompts]
+    pending = []
+    for i, key in enumerate(keys):
+        cached = cache.get(key) if cache else None
+        if cached:
+            outcomes[i] = cached
+        else:
+            pending.append(i)
+    if not pending:
+        print(f"    Using cached translations for all {len(prompts)} chunks")
+        return outcomes
+    
+    print(f"    Submitting {len(pending)} chunks as one batch via {provider.name}...")
+    await bucket.acquire()
+    results = await provider.process_batch([prompts[i] for i in pending], json_output=json_output)
+    for i, result in zip(pending, results):
+        if result is None:
+            continue
+        outcomes[i] = (result, provider.name)
+        if cache and is_cacheable(result, config, checks[i] if checks else None):
+            cache.set(keys[i], result, provider.name)
+    missing = sum(1 for result in results if result is None)
+    if missing:
+        print(f"    Batch returned no usable result for {missing}/{len(pending)} chunks, sending those individually")
+    return outcomes
+
+
+async def translate_prompts(providers, prompts: list[str], config: dict, bucket: TokenBucket,
+                            cache: TranslationCache | None, json_output: bool = False,
+                            checks: list | None = None) -> list[tuple[str, str] | TruncatedResponseError]:
+    outcomes = [None] * len(prompts)
+    provider = providers[0]
+    if provider.supports_batch and len(prompts) >= BATCH_MIN_CHUNKS and provider.disabled_until <= time.monotonic():
+        try:
+            outcomes = await translate_prompts_batch(provider, prompts, config, bucket, cache, json_output, checks)
+        except Exception as e:
+            print(f"    Batch via {provider.name} failed, falling back to per-chunk requests: {e}")
+    missing = [i for i, outcome in enumerate(outcomes) if outcome is None]
+    
+    semaphore = asyncio.Semaphore(config['rate_limit'].get('max_concurrency', DEFAULT_MAX_CONCURRENCY))
+    
+    async def translate_chunk(i, prompt):
+        async with semaphore:
+            if len(prompts) > 1:
+                print(f"    Processing chunk {i+1}/{len(prompts)}...")
+            return await process_cached(providers, prompt, config, bucket, cache, json_output,
+                                        checks[i] if checks else None)
+    
+    # Let sibling chunks finish (and reach the cache) even if one fails, so a re-run only redoes the failure
+    settled = await asyncio.gather(*(translate_chunk(i, prompts[i]) for i in missing), return_exceptions=True)
+    # Truncated chunks are handed back so the caller can split them; anything else fails the file
+    for i, outcome in zip(missing, settled):
+        if isinstance(outcome, BaseException) and not isinstance(outcome, TruncatedResponseError):
+            raise outcome
+        outcomes[i] = outcome
+    return outcomes
+
+
+def halve_text_chunk(chunk: str) -> list[str]:
+    # Cut at the [N] marker closest to the middle so no block is split between the halves
+    starts = [match.start() for match in _MARKER_RE.finditer(chunk)][1:]
+    if not starts:
+        return [chunk]
+    middle = min(starts, key=lambda start: abs(start - len(chunk) // 2))
+    return [chunk[:middle].rstrip(), chunk[middle:]]
+
+
+def halve_blocks(blocks: list[dict]) -> list[list[dict]]:
+    middle = len(blocks) // 2
+    return [blocks[:middle], blocks[middle:]] if middle else [blocks]
+
+
+async def translate_chunks(providers, chunks: list, render, expects, halve, config: dict, bucket: TokenBucket,
+                           cache: TranslationCache | None, json_output: bool = False,
+                           depth: int = 0) -> list[tuple]:
+    # Returns (chunk, result, provider) per chunk; a chunk truncated on every provider is retried in halves
+    outcomes = await translate_prompts(providers, [render(chunk) for chunk in chunks], config, bucket, cache,
+                                       json_output, [expects(chunk) for chunk in chunks])
+    
+    async def settle(chunk, outcome):
+        if not isinstance(outcome, TruncatedResponseError):
+            return [(chunk, *outcome)]
+        halves = halve(chunk) if depth < MAX_SPLIT_DEPTH else [chunk]
+        if len(halves) > 1:
+            print(f"    Output truncated by every provider, retrying as {len(halves)} smaller chunks")
+            return await translate_chunks(providers, halves, render, expects, halve, config, bucket, cache,
+                                          json_output, depth + 1)
+        # Last resort: keep the partial answer (never cached) and let the completeness check report the gap
+        print("    Warning: output still truncated, keeping the partial translation")
+        return [(chunk, outcome.partial, outcome.provider)]
+    
+    settled = await asyncio.gather(*(settle(chunk, outcome) for chunk, outcome in zip(chunks, outcomes)))
+    return [entry for entries in settled for entry in entries]
+
+
+async def process_large_text(providers, raw_text: str, config: dict, bucket: TokenBucket,
+                             cache: TranslationCache | None = None) -> tuple[str, str | None]:
     chunk_size = get_effective_chunk_size(providers)
     
     if len(raw_text) <= chunk_size:
-        prompt = build_prompt(config['processing']['prompt'], raw_text, config)
-        result, provider = process_with_fallback(providers, prompt, config)
-        return result, provider
+        chunks = [raw_text]
+    else:
+        chunks = split_text_into_chunks(raw_text, chunk_size)
+        print(f"    Split into {len(chunks)} chunks ({[len(c) for c in chunks]} chars each, limit: {chunk_size})")
+    
+    render = compile_prompt(config['processing']['prompt'], config)
+    results = await translate_chunks(providers, chunks, render, expects_blocks, halve_text_chunk,
+                                     config, bucket, cache)
     
-    chunks = split_text_into_chunks(raw_text, chunk_size)
-    print(f"    Split into {len(chunks)} chunks ({[len(c) for c in chunks]} chars each, limit: {chunk_size})")
+    combined = '\n\n'.join(result for _, result, _ in results)
+    return combined, results[-1][2]
+
+
+async def translate_blocks_json(providers, blocks: list[dict], config: dict, bucket: TokenBucket,
+                                cache: TranslationCache | None = None) -> tuple[dict[int, str], str | None]:
+    chunk_size = get_effective_chunk_size(providers)
+    chunks = split_blocks_into_chunks(blocks, chunk_size)
+    if len(chunks) > 1:
+        print(f"    Split into {len(chunks)} chunks ({[len(c) for c in chunks]} blocks each, limit: {chunk_size} chars)")
     
-    results = []
-    last_provider = None
+    render_json = compile_prompt(config['processing']['json_prompt'], config)
+    results = await translate_chunks(providers, chunks, lambda chunk: render_json(blocks_to_json_text(chunk)),
+                                     expects_json_blocks, halve_blocks, config, bucket, cache, json_output=True)
     
-    for i, chunk in enumerate(chunks):
-        print(f"    Processing chunk {i+1}/{len(chunks)}...")
-        prompt = build_prompt(config['processing']['prompt'], chunk, config)
-        result, provider = process_with_fallback(providers, prompt, config)
-        results.append(result)
-        last_provider = provider
-        if i < len(chunks) - 1:
-            delay = 60.0 / config['rate_limit']['requests_per_minute']
-            time.sleep(delay)
+    translated_map = {}
+    for chunk, result, _ in results:
+        translated_map.update(parse_json_translations(result, chunk))
+    return translated_map, results[-1][2]
+
+
+def fingerprint_file(output_file: Path) -> Path:
+    return output_file.with_name(f".{output_file.name}.fingerprint")
+
+
+def output_fingerprint(config: dict, providers) -> str:
+    # Everything that changes the translation: effective processing settings (after CLI overrides) and the model
+    settings = {'processing': config['processing'], 'model': providers[0].model}
+    payload = json.dumps(settings, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+
+def write_srt(output_file: Path, blocks: list[dict], translations: list[str | None], fingerprint: str | None = None):
+    # Stream lines straight into a large buffer instead of joining the whole file in memory;
+    # write beside the target and rename, so a failure mid-stream never leaves a partial output
+    fingerprint_file(output_file).unlink(missing_ok=True)
+    tmp_file = output_file.with_name(f".{output_file.name}.tmp")
+    try:
+        with open(tmp_file, 'w', encoding='utf-8', buffering=1 << 20) as f:
+            f.writelines(iter_srt_lines(blocks, translations))
+        os.replace(tmp_file, output_file)
+    except BaseException:
+        tmp_file.unlink(missing_ok=True)
+        raise
+    # Only complete outputs get a fingerprint, so partial ones are retried on the next run
+    if fingerprint:
+        fingerprint_file(output_file).write_text(fingerprint, encoding='utf-8')
+
+
+def is_output_current(srt_file: Path, output_file: Path, fingerprint: str) -> bool:
+    # Up to date when written after the input changed, complete, and with the same settings and model
+    try:
+        if output_file.stat().st_mtime < srt_file.stat().st_mtime:
+            return False
+        return fingerprint_file(output_file).read_text(encoding='utf-8') == fingerprint
+    except OSError:
+        return False
+
+
+async def translate_file(i: int, total: int, srt_file: Path, loading: asyncio.Future, providers, config: dict,
+                         bucket: TokenBucket, cache: TranslationCache | None, fingerprint: str):
+    print(f"[{i}/{total}] {srt_file.name}")
     
-    combined = '\n\n'.join(results)
-    return combined, last_provider
+    try:
+        blocks = await loading
+        
+        if not blocks:
+            print(f"    Skipping {srt_file.name}: No subtitle blocks found")
+            return
+        
+        unique_blocks, id_map = dedupe_blocks(blocks)
+        if len(unique_blocks) < len(blocks):
+            print(f"    {len(blocks) - len(unique_blocks)} duplicate lines will reuse one translation")
+        raw_text = blocks_to_translatable_text(unique_blocks)
+        
+        if not raw_text.strip():
+            print(f"    Skipping {srt_file.name}: No text content found")
+            return
+        
+        if config['processing'].get('structured_output', False):
+            unique_map, used_provider = await translate_blocks_json(providers, unique_blocks, config, bucket, cache)
+        else:
+            translated_text, used_provider = await process_large_text(providers, raw_text, config, bucket, cache)
+            unique_map = parse_translated_map(translated_text)
+        # Expand by position: SRT numbering may restart (e.g. concatenated parts), so indexes can repeat
+        translations = [unique_map.get(unique_id) for unique_id in id_map]
+        
+        is_complete, rate = check_translation_completeness(blocks, translations, config)
+        if not is_complete:
+            print(f"    Warning: {srt_file.name} only {rate*100:.1f}% translated, some blocks may be in original language")
+        
+        output_file = OUTPUT_DIR / f"{srt_file.stem}.srt"
+        await asyncio.to_thread(write_srt, output_file, blocks, translations,
+                                fingerprint if is_complete else None)
+        
+        print(f"    Done via {used_provider} -> {output_file.name}")
+        
+    except Exception as e:
+        print(f"    Failed {srt_file.name}: {e}")
 
 
-def main():
+async def main():
     parser = argparse.ArgumentParser(description='Translate SRT subtitle files with AI')
     parser.add_argument('--provider', '-p', 
                         help='Use only this provider (e.g., alibaba, openrouter, siliconflow)')
@@ -222,6 +751,10 @@ def main():
                         help='Context for translation (overrides config)')
     parser.add_argument('--style',
                         help='Translation style: natural, literal, formal (overrides config)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Ignore and do not update the translation cache')
+    parser.add_argument('--force', '-f', action='store_true',
+                        help='Retranslate files whose output is already up to date')
     args = parser.parse_args()
     
     config = load_config()
@@ -242,13 +775,16 @@ def main():
     if args.style:
         config['processing']['translation_style'] = args.style
     
-    providers = get_enabled_providers(config)
+    enabled_providers = get_enabled_providers(config, args.provider)
+    providers = enabled_providers
     
     if args.provider:
-        providers = [p for p in providers if p.name == args.provider]
         if not providers:
             print(f"Error: Provider '{args.provider}' not found or not enabled")
-            print(f"Available: {[p.name for p in get_enabled_providers(config)]}")
+            # Rare error path: build the rest only to list providers that could actually run (keys set)
+            available = get_enabled_providers(config)
+            print(f"Available: {[p.name for p in available]}")
+            await close_providers(available)
             return
         print(f"Using only: {args.provider}")
     
@@ -261,65 +797,53 @@ def main():
     print(f"Style: {config['processing'].get('translation_style', 'natural')}")
     print(f"Context: {config['processing'].get('context', 'General content')[:60]}...")
     
-    srt_files = list(INPUT_DIR.glob("*.srt"))
+    srt_files = find_srt_files(INPUT_DIR)
     
     if not srt_files:
         print("No .srt files found in input/")
+        await close_providers(enabled_providers)
         return
     
+    fingerprint = output_fingerprint(config, providers)
+    if not args.force:
+        pending = [f for f in srt_files if not is_output_current(f, OUTPUT_DIR / f"{f.stem}.srt", fingerprint)]
+        if len(pending) < len(srt_files):
+            print(f"Skipping {len(srt_files) - len(pending)} file(s) with up-to-date output (use --force to redo)")
+        srt_files = pending
+        if not srt_files:
+            await close_providers(enabled_providers)
+            return
+    
     print(f"\nProcessing {len(srt_files)} SRT file(s)...\n")
     
     rate_config = config['rate_limit']
-    delay = 60.0 / rate_config['requests_per_minute']
+    bucket = TokenBucket(rate_config['requests_per_minute'] / 60.0, rate_config.get('burst', 1))
+    cache_config = config.get('cache', {})
+    cache = None
+    if cache_config.get('enabled', True) and not args.no_cache:
+        cache = TranslationCache(Path(cache_config.get('path', TRANSLATION_CACHE_FILE)),
+                                 cache_config.get('memory_size', 512))
+    
+    # Files overlap too; every request still draws from the one token bucket
+    file_slots = asyncio.Semaphore(rate_config.get('max_parallel_files', DEFAULT_MAX_PARALLEL_FILES))
+    
+    async def bounded(i, srt_file, loading):
+        async with file_slots:
+            await translate_file(i, len(srt_files), srt_file, loading, providers, config, bucket, cache,
+                                 fingerprint)
     
+    # Start every read/parse now in worker threads, so later files are ready when a slot frees up
+    loads = [asyncio.ensure_future(asyncio.to_thread(load_srt_blocks, srt_file)) for srt_file in srt_files]
     try:
-        for i, srt_file in enumerate(srt_files, 1):
-            print(f"[{i}/{len(srt_files)}] {srt_file.name}")
-            
-            try:
-                srt_content = read_srt(srt_file)
-                blocks = parse_srt(srt_content)
-                
-                if not blocks:
-                    print(f"    Skipping: No subtitle blocks found")
-                    continue
-                
-                raw_text = blocks_to_translatable_text(blocks)
-                
-                if not raw_text.strip():
-                    print(f"    Skipping: No text content found")
-                    continue
-                
-                translated_text, used_provider = process_large_text(providers, raw_text, config)
-                
-                translated_texts = parse_translated_text(translated_text, len(blocks))
-                
-                is_complete, rate = check_translation_completeness(translated_texts, config)
-                if not is_complete:
-                    print(f"    Warning: Only {rate*100:.1f}% translated, some blocks may be in original language")
-                
-                output_content = build_srt(blocks, translated_texts)
-                
-                output_file = OUTPUT_DIR / f"{srt_file.stem}.srt"
-                with open(output_file, 'w', encoding='utf-8') as f:
-                    f.write(output_content)
-                
-                print(f"    Done via {used_provider} -> {output_file.name}")
-                
-            except Exception as e:
-                print(f"    Failed: {e}")
-            
-            if i < len(srt_files):
-                time.sleep(delay)
+        await asyncio.gather(*(bounded(i, srt_file, loading)
+                               for i, (srt_file, loading) in enumerate(zip(srt_files, loads), 1)))
     finally:
-        for provider in providers:
-            try:
-                provider.close()
-            except Exception:
-                pass
+        await close_providers(enabled_providers)
+        if cache:
+            cache.close()
     
     print("\nAll done!")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())